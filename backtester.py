@@ -0,0 +1,170 @@
+'''
+
+Vectorized options strategy backtester over the EquityDailyPrice history
+
+'''
+
+import os
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+
+import option
+from blackscholes_model import bs_price, bs_greeks
+
+
+def load_close_prices(db_connection, tickers, start_date, end_date):
+    '''
+    bulk equivalent of Stock.get_daily_hist_price for many tickers
+    return a DataFrame of Close prices indexed by date with one column per ticker
+    '''
+    placeholders = ','.join(['?'] * len(tickers))
+    sql = f"select Ticker, substr(AsOfDate, 1, 10) as AsOfDate, Close from EquityDailyPrice " \
+          f"where Ticker in ({placeholders}) and substr(AsOfDate, 1, 10) between ? and ? order by AsOfDate asc"
+    df = pd.read_sql(sql, db_connection, params=list(tickers) + [str(start_date), str(end_date)])
+    df['AsOfDate'] = pd.to_datetime(df['AsOfDate']).dt.date
+
+    close_df = df.pivot_table(index='AsOfDate', columns='Ticker', values='Close', aggfunc='last')
+    return(close_df.reindex(columns=[t for t in tickers if t in close_df.columns]))
+
+
+class BacktestResult(object):
+    '''
+    daily P&L per share of underlying as a float32 (dates x tickers) array, P&L on day t is for
+    the holding period from t-1 to t, and the number of hedge trades per ticker
+    '''
+
+    def __init__(self, strategy, dates, tickers, pnl, hedge_counts):
+        self.strategy = strategy
+        self.dates = dates
+        self.tickers = tickers
+        self.pnl = pnl
+        self.hedge_counts = hedge_counts
+
+    def get_pnl_frame(self):
+        return(pd.DataFrame(self.pnl, index=self.dates, columns=self.tickers))
+
+    def get_summary(self):
+        pnl = self.pnl.astype(np.float64)
+        num_days = np.sum(~np.isnan(pnl), axis=0)
+        mean = np.nanmean(pnl, axis=0)
+        std = np.nanstd(pnl, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sharpe = np.where(std > 0, mean / std * np.sqrt(252), np.nan)
+        return(pd.DataFrame({'total_pnl': np.nansum(pnl, axis=0), 'num_days': num_days,
+                             'sharpe': sharpe, 'hedge_count': self.hedge_counts}, index=self.tickers))
+
+
+class OptionsBacktester(object):
+    '''
+    Simulate option strategies on every ticker of a Close price frame at once
+    options are priced with Black-Scholes using the realized vol of the trailing vol_window days
+    all dates and tickers are repriced together as (dates x tickers) arrays
+    '''
+
+    def __init__(self, close_df, risk_free_rate, vol_window=21, days_per_year=252):
+        self.dates = np.array(close_df.index)
+        self.tickers = list(close_df.columns)
+        self.risk_free_rate = risk_free_rate
+        self.days_per_year = days_per_year
+
+        self.prices = close_df.to_numpy(dtype=np.float64)
+        log_returns = np.log(close_df).diff()
+        self.sigma = (log_returns.rolling(vol_window).std() * np.sqrt(days_per_year)).to_numpy(dtype=np.float64)
+
+    def _get_schedule(self, roll_days):
+        # for the holding period (t-1, t], index of the day the option was written and of its expiry
+        t = np.arange(1, len(self.dates))
+        written = ((t - 1) // roll_days) * roll_days
+        return(t, written, written + roll_days)
+
+    def _option_values(self, value_idx, expiry_idx, strike, is_call):
+        # value of the option on the value_idx days, intrinsic value on the expiry day
+        S_0 = self.prices[value_idx]
+        sigma = self.sigma[value_idx]
+        T = ((expiry_idx - value_idx) / self.days_per_year)[:, None]
+        alive = T > 0
+        safe_T = np.where(alive, T, 1.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            px = bs_price(S_0, strike, safe_T, self.risk_free_rate, 0, sigma, is_call)
+        payoff = np.where(is_call, np.maximum(S_0 - strike, 0), np.maximum(strike - S_0, 0))
+        return(np.where(alive, px, payoff))
+
+    def _option_deltas(self, value_idx, expiry_idx, strike, is_call):
+        S_0 = self.prices[value_idx]
+        T = ((expiry_idx - value_idx) / self.days_per_year)[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return(bs_greeks(S_0, strike, T, self.risk_free_rate, 0, self.sigma[value_idx], is_call)['delta'])
+
+    def run_covered_call(self, roll_days=21, moneyness=1.05):
+        '''
+        long one share and short one call struck at moneyness x spot, rolled every roll_days
+        '''
+        t, written, expiry = self._get_schedule(roll_days)
+        strike = self.prices[written] * moneyness
+
+        call_change = self._option_values(t, expiry, strike, True) - self._option_values(t - 1, expiry, strike, True)
+        pnl = (self.prices[t] - self.prices[t - 1]) - call_change
+
+        hedge_counts = np.zeros(len(self.tickers), dtype=np.int32)
+        return(self._make_result('covered_call', pnl, hedge_counts))
+
+    def run_delta_hedged_straddle(self, roll_days=21, hedge_every=1):
+        '''
+        long an at-the-money straddle rolled every roll_days and delta hedged with the underlying
+        every hedge_every days, financing of the hedge is ignored
+        '''
+        t, written, expiry = self._get_schedule(roll_days)
+        strike = self.prices[written]
+
+        straddle_change = (self._option_values(t, expiry, strike, True) - self._option_values(t - 1, expiry, strike, True)) + \
+                          (self._option_values(t, expiry, strike, False) - self._option_values(t - 1, expiry, strike, False))
+
+        # hedge held over (t-1, t] was set on the last rebalance day at or before t-1
+        hedged = written + ((t - 1 - written) // hedge_every) * hedge_every
+        delta = self._option_deltas(hedged, expiry, strike, True) + self._option_deltas(hedged, expiry, strike, False)
+        pnl = straddle_change - delta * (self.prices[t] - self.prices[t - 1])
+
+        rebalance = (t - 1) == hedged
+        hedge_counts = np.sum(rebalance[:, None] & ~np.isnan(pnl), axis=0).astype(np.int32)
+        return(self._make_result('delta_hedged_straddle', pnl, hedge_counts))
+
+    def _make_result(self, strategy, pnl, hedge_counts):
+        full_pnl = np.full(self.prices.shape, np.nan, dtype=np.float32)
+        full_pnl[1:] = pnl
+        return(BacktestResult(strategy, self.dates, self.tickers, full_pnl, hedge_counts))
+
+
+def _test():
+    parser = option.get_default_parser()
+    parser.add_argument('--data_dir', dest = 'data_dir', default='./data', help='data dir')
+
+    args = parser.parse_args()
+    opt = option.Option(args = args)
+    option.set_data_paths(opt)
+    db_connection = sqlite3.connect(opt.sqlite_db)
+
+    if opt.tickers is not None:
+        list_of_tickers = opt.tickers.split(',')
+    else:
+        fname = os.path.join(opt.data_dir, "S&P500.txt")
+        list_of_tickers = list(pd.read_csv(fname, header=None).iloc[:, 0])
+
+    start = time.time()
+    close_df = load_close_prices(db_connection, list_of_tickers, opt.start_date, opt.end_date)
+    print(f"Loaded {close_df.shape[0]} days for {close_df.shape[1]} tickers in {time.time() - start:.2f}s")
+
+    backtester = OptionsBacktester(close_df, risk_free_rate=0.05)
+
+    start = time.time()
+    covered_call = backtester.run_covered_call(roll_days=21, moneyness=1.05)
+    straddle = backtester.run_delta_hedged_straddle(roll_days=21, hedge_every=5)
+    print(f"Ran backtests in {time.time() - start:.2f}s")
+
+    print(covered_call.get_summary().head())
+    print(straddle.get_summary().head())
+
+if __name__ == "__main__":
+    _test()
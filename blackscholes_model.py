@@ -7,20 +7,195 @@ Black-Scholes Model
 
 import datetime
 
+import numpy as np
 from scipy.stats import norm
 from math import log, exp, sqrt
 
 from stock import Stock
 from financial_option import *
+from volatility_surface import VolatilitySurface
+from term_structure import YieldCurve, DividendCurve
+
+
+def bs_price(S_0, K, T, r, q, sigma, is_call, df_r=None, df_q=None):
+    '''
+    vectorized Black-Scholes price of European options, all inputs are arrays or scalars
+    df_r and df_q are the rate and dividend discount factors, computed from r and q if not given
+    '''
+    if df_r is None:
+        df_r = np.exp(-np.asarray(r) * T)
+    if df_q is None:
+        df_q = np.exp(-np.asarray(q) * T)
+    S_0, K, T, r, q, sigma, is_call, df_r, df_q = np.broadcast_arrays(S_0, K, T, r, q, sigma, is_call, df_r, df_q)
+    sqrt_T = np.sqrt(T)
+    d1 = (np.log(S_0 / K) + (r - q + sigma ** 2 / 2) * T) / (sigma * sqrt_T)
+    d2 = d1 - sigma * sqrt_T
+    fwd = S_0 * df_q
+    pv_strike = K * df_r
+
+    call_px = fwd * norm.cdf(d1) - pv_strike * norm.cdf(d2)
+    put_px = pv_strike * norm.cdf(-d2) - fwd * norm.cdf(-d1)
+    return(np.where(is_call, call_px, put_px))
+
+
+def bs_greeks(S_0, K, T, r, q, sigma, is_call, df_r=None, df_q=None):
+    '''
+    vectorized Black-Scholes price and greeks of European options
+    return a dict of arrays with keys price, delta, gamma, theta, vega and rho
+    '''
+    if df_r is None:
+        df_r = np.exp(-np.asarray(r) * T)
+    if df_q is None:
+        df_q = np.exp(-np.asarray(q) * T)
+    S_0, K, T, r, q, sigma, is_call, df_r, df_q = np.broadcast_arrays(S_0, K, T, r, q, sigma, is_call, df_r, df_q)
+    sqrt_T = np.sqrt(T)
+    d1 = (np.log(S_0 / K) + (r - q + sigma ** 2 / 2) * T) / (sigma * sqrt_T)
+    d2 = d1 - sigma * sqrt_T
+    fwd = S_0 * df_q
+    pv_strike = K * df_r
+    pdf_d1 = norm.pdf(d1)
+    # N(d) for calls and -N(-d) for puts
+    sign = np.where(is_call, 1.0, -1.0)
+    n_d1 = sign * norm.cdf(sign * d1)
+    n_d2 = sign * norm.cdf(sign * d2)
+
+    result = {}
+    result['price'] = fwd * n_d1 - pv_strike * n_d2
+    result['delta'] = df_q * n_d1
+    result['gamma'] = df_q * pdf_d1 / (S_0 * sigma * sqrt_T)
+    result['theta'] = -fwd * pdf_d1 * sigma / (2 * sqrt_T) + q * fwd * n_d1 - r * pv_strike * n_d2
+    result['vega'] = fwd * pdf_d1 * sqrt_T
+    result['rho'] = K * T * df_r * n_d2
+    return(result)
+
+
+def bs_implied_vol(price, S_0, K, T, r, q, is_call, tol=1e-8, max_iter=100):
+    '''
+    vectorized implied vol of European options by Newton's method safeguarded with bisection
+    return nan where the price is outside the no-arbitrage bounds
+    '''
+    shape = np.broadcast(price, S_0, K, T, r, q, is_call).shape
+    price, S_0, K, T, r, q, is_call = [np.array(x, dtype=float).ravel() for x in
+                                       np.broadcast_arrays(price, S_0, K, T, r, q, is_call)]
+    is_call = is_call > 0
+    df_r = np.exp(-r * T)
+    df_q = np.exp(-q * T)
+    fwd = S_0 * df_q
+    pv_strike = K * df_r
+
+    lower_bound = np.where(is_call, np.maximum(fwd - pv_strike, 0), np.maximum(pv_strike - fwd, 0))
+    upper_bound = np.where(is_call, fwd, pv_strike)
+    valid = (price > lower_bound) & (price < upper_bound)
+
+    lo = np.full(price.shape, 1e-6)
+    hi = np.full(price.shape, 10.0)
+    sigma = np.full(price.shape, 0.3)
+    active = valid.copy()
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        g = bs_greeks(S_0[active], K[active], T[active], r[active], q[active], sigma[active],
+                      is_call[active], df_r[active], df_q[active])
+        diff = g['price'] - price[active]
+
+        # keep a bracket around the root and fall back to bisection when newton leaves it
+        s = sigma[active]
+        lo[active] = np.where(diff < 0, s, lo[active])
+        hi[active] = np.where(diff > 0, s, hi[active])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = s - diff / g['vega']
+        bisect = (lo[active] + hi[active]) / 2
+        inside = np.isfinite(newton) & (newton >= lo[active]) & (newton <= hi[active])
+        done = np.abs(diff) < tol * np.maximum(price[active], 1.0)
+        sigma[active] = np.where(done, s, np.where(inside, newton, bisect))
+
+        idx = np.flatnonzero(active)
+        active[idx[done]] = False
+
+    return(np.where(valid, sigma, np.nan).reshape(shape))
+
 
 class BlackScholesModel(object):
     '''
     Implementation of the Black-Schole Model for pricing European options
     '''
 
-    def __init__(self, pricing_date, risk_free_rate):
+    def __init__(self, pricing_date, risk_free_rate, vol_surfaces=None, yield_curve=None, dividend_curves=None):
         self.pricing_date = pricing_date
         self.risk_free_rate = risk_free_rate
+        # optional VolatilitySurface per ticker, used instead of the flat Stock.sigma
+        self.vol_surfaces = {}
+        if vol_surfaces is not None:
+            for surface in vol_surfaces:
+                self.set_vol_surface(surface)
+        # optional YieldCurve used instead of the flat risk_free_rate
+        self.yield_curve = yield_curve
+        # optional DividendCurve per ticker, used instead of the flat Stock.dividend_yield
+        self.dividend_curves = {}
+        if dividend_curves is not None:
+            for curve in dividend_curves:
+                self.set_dividend_curve(curve)
+
+        # flat curves built on demand so discount factors are cached in every case
+        self._flat_yield_curves = {}
+        self._flat_dividend_curves = {}
+
+    def set_vol_surface(self, surface):
+        self.vol_surfaces[surface.ticker] = surface
+
+    def set_dividend_curve(self, curve):
+        self.dividend_curves[curve.ticker] = curve
+
+    def get_yield_curve(self):
+        if self.yield_curve is not None:
+            return(self.yield_curve)
+        curve = self._flat_yield_curves.get(self.risk_free_rate)
+        if curve is None:
+            curve = YieldCurve.flat(self.risk_free_rate)
+            self._flat_yield_curves[self.risk_free_rate] = curve
+        return(curve)
+
+    def get_dividend_curve(self, underlying):
+        return(self._get_dividend_curve(underlying.ticker, underlying.dividend_yield))
+
+    def _get_dividend_curve(self, ticker, dividend_yield):
+        curve = self.dividend_curves.get(ticker)
+        if curve is not None:
+            return(curve)
+        curve = self._flat_dividend_curves.get(dividend_yield)
+        if curve is None:
+            curve = DividendCurve(None, dividend_yield)
+            self._flat_dividend_curves[dividend_yield] = curve
+        return(curve)
+
+    def get_market_inputs(self, option):
+        '''
+        return S_0, K, T, r, q, sigma and the discount factors df_r, df_q for the option
+        S_0 is net of the present value of discrete dividends paid before expiry
+        '''
+        T = option.time_to_expiry
+        yield_curve = self.get_yield_curve()
+        dividend_curve = self.get_dividend_curve(option.underlying)
+
+        S_0 = option.underlying.spot_price
+        if dividend_curve.dividends:
+            S_0 = S_0 - dividend_curve.get_pv_dividends(T, yield_curve)
+        r = yield_curve.get_zero_rate(T)
+        q = dividend_curve.dividend_yield
+        sigma = self.get_sigma(option)
+
+        return(S_0, option.strike, T, r, q, sigma,
+               yield_curve.get_discount_factor(T), dividend_curve.get_discount_factor(T))
+
+    def get_sigma(self, option):
+        '''
+        return the vol for the option from the underlying's surface if there is one
+        else the flat sigma of the underlying stock
+        '''
+        surface = self.vol_surfaces.get(option.underlying.ticker)
+        if surface is None:
+            return(option.underlying.sigma)
+        return(surface.get_vol(option.strike, option.time_to_expiry, option.underlying.spot_price))
 
     def calc_parity_price(self, option, option_price):
         '''
@@ -28,11 +203,12 @@ class BlackScholesModel(object):
         else return the call price from Put-Call Parity if input option is a put
         '''
         result = None
+        S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
 
         if option.option_type == FinancialOption.Type.CALL:
-            result = option_price + option.strike * exp(-self.risk_free_rate * option.time_to_expiry) - option.underlying.spot_price
+            result = option_price + K * df_r - S_0 * df_q
         elif option.option_type == FinancialOption.Type.PUT:
-            result = option_price - option.strike * exp(-self.risk_free_rate * option.time_to_expiry) + option.underlying.spot_price
+            result = option_price - K * df_r + S_0 * df_q
       
         return(result)
 
@@ -44,38 +220,118 @@ class BlackScholesModel(object):
         if option.option_style == FinancialOption.Style.AMERICAN:
             raise Exception("B\S price for American option not implemented yet")
         else:
-            S_0 = option.underlying.spot_price
-            K = option.strike
-            T = option.time_to_expiry
-            r = self.risk_free_rate
-            q = option.underlying.dividend_yield
-            sigma = option.underlying.sigma 
+            S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
             d1 = (log(S_0/K)+(r-q+pow(sigma, 2)/2)*T)/(sigma * sqrt(T))
             d2 = d1 - (sigma * sqrt(T))
 
             if option.option_type == FinancialOption.Type.CALL:
-                px = (S_0 * exp(-q * T) * norm.cdf(d1)) - (K * exp(-r * T) * norm.cdf(d2))
+                px = (S_0 * df_q * norm.cdf(d1)) - (K * df_r * norm.cdf(d2))
             else:
-                px = (K * exp(-r * T) * norm.cdf(-d2)) - (S_0 * exp(-q * T) * norm.cdf(-d1))
+                px = (K * df_r * norm.cdf(-d2)) - (S_0 * df_q * norm.cdf(-d1))
 
         return(px)
 
+    def get_market_input_arrays(self, options):
+        '''
+        return arrays of S_0, K, T, r, q, sigma, is_call, df_r, df_q for a list of European options
+        '''
+        if any(o.option_style == FinancialOption.Style.AMERICAN for o in options):
+            raise Exception("B\\S price for American option not implemented yet")
+
+        index = {}
+        underlyings = []
+        underlying = np.empty(len(options), dtype=np.intp)
+        for i, o in enumerate(options):
+            u = index.get(id(o.underlying))
+            if u is None:
+                u = index[id(o.underlying)] = len(underlyings)
+                underlyings.append(o.underlying)
+            underlying[i] = u
+
+        return(self.get_market_input_columns([u.ticker for u in underlyings],
+                                             [u.spot_price for u in underlyings],
+                                             [u.sigma if u.ticker not in self.vol_surfaces else np.nan for u in underlyings],
+                                             [u.dividend_yield for u in underlyings],
+                                             underlying,
+                                             [o.strike for o in options],
+                                             [o.time_to_expiry for o in options],
+                                             [o.option_type == FinancialOption.Type.CALL for o in options]))
+
+    def get_market_input_columns(self, tickers, spot_price, sigma, dividend_yield, underlying, K, T, is_call):
+        '''
+        return arrays of S_0, K, T, r, q, sigma, is_call, df_r, df_q for European options given as columns
+        tickers, spot_price, sigma and dividend_yield are per underlying and underlying indexes into them
+        discount factors are computed once per distinct expiry and reused across strikes
+        '''
+        underlying = np.asarray(underlying, dtype=np.intp)
+        S_0 = np.asarray(spot_price, dtype=float)[underlying]
+        sigma = np.asarray(sigma, dtype=float)[underlying]
+        dividend_yield = np.asarray(dividend_yield, dtype=float)
+        K = np.asarray(K, dtype=float)
+        T = np.asarray(T, dtype=float)
+        is_call = np.asarray(is_call, dtype=bool)
+
+        expiries, expiry_idx = np.unique(T, return_inverse=True)
+        expiry_idx = expiry_idx.reshape(T.shape)
+        yield_curve = self.get_yield_curve()
+        df_r = yield_curve.get_discount_factors(expiries)[expiry_idx]
+        r = yield_curve.get_zero_rates(expiries)[expiry_idx]
+
+        # flat dividend yields use a small (underlying x expiry) table of discount factors
+        q = dividend_yield[underlying]
+        df_q = np.exp(-np.outer(dividend_yield, expiries))[underlying, expiry_idx]
+
+        # vol surface and dividend curve lookups are done once per underlying on all its positions
+        for u, ticker in enumerate(tickers):
+            surface = self.vol_surfaces.get(ticker)
+            curve = self.dividend_curves.get(ticker)
+            if surface is None and curve is None:
+                continue
+            idx = np.flatnonzero(underlying == u)
+            if len(idx) == 0:
+                continue
+            if surface is not None:
+                sigma[idx] = surface.get_vols(K[idx], T[idx], S_0[idx])
+            if curve is not None:
+                q[idx] = curve.dividend_yield
+                df_q[idx] = curve.get_discount_factors(T[idx])
+                if curve.dividends:
+                    S_0[idx] -= curve.get_pvs_dividends(T[idx], yield_curve)
+
+        return(S_0, K, T, r, q, sigma, is_call, df_r, df_q)
+
+    def calc_model_prices(self, options):
+        '''
+        Calculate the prices of a list of European options (e.g. a whole chain) in one vectorized call
+        '''
+        return(bs_price(*self.get_market_input_arrays(options)))
+
+    def calc_model_greeks(self, options):
+        '''
+        Calculate the prices and all the greeks of a list of European options in one vectorized call
+        '''
+        return(bs_greeks(*self.get_market_input_arrays(options)))
+
+    def calc_implied_vol(self, option, option_price):
+        '''
+        Calculate the vol that reproduces the option price under the Black-Scholes model
+        '''
+        if option.option_style == FinancialOption.Style.AMERICAN:
+            raise Exception("B\\S price for American option not implemented yet")
+        S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
+        return(float(bs_implied_vol(option_price, S_0, K, T, r, q, option.option_type == FinancialOption.Type.CALL)))
+
     def calc_delta(self, option):
         if option.option_style == FinancialOption.Style.AMERICAN:
             raise Exception("B\S price for American option not implemented yet")
         elif option.option_style == FinancialOption.Style.EUROPEAN:
-            S_0 = option.underlying.spot_price
-            K = option.strike
-            T = option.time_to_expiry
-            r = self.risk_free_rate
-            q = option.underlying.dividend_yield
-            sigma = option.underlying.sigma       
+            S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
             d1 = (log(S_0/K)+(r-q+pow(sigma, 2)/2)*T)/(sigma * sqrt(T))
 
             if option.option_type == FinancialOption.Type.CALL:
-                result = exp(-q * T) * norm.cdf(d1)
+                result = df_q * norm.cdf(d1)
             else:
-                result = exp(-q * T) * (norm.cdf(d1) - 1)
+                result = df_q * (norm.cdf(d1) - 1)
 
         else:
             raise Exception("Unsupported option type")
@@ -87,18 +343,13 @@ class BlackScholesModel(object):
         if option.option_style == FinancialOption.Style.AMERICAN:
             raise Exception("B\S price for American option not implemented yet")
         elif option.option_style == FinancialOption.Style.EUROPEAN:
-            S_0 = option.underlying.spot_price
-            K = option.strike
-            T = option.time_to_expiry
-            r = self.risk_free_rate
-            q = option.underlying.dividend_yield
-            sigma = option.underlying.sigma
+            S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
             d1 = (np.log(S_0 / K) + (r - q + sigma ** 2 / 2) * T) / (sigma * sqrt(T))
 
             if option.option_type == FinancialOption.Type.CALL:
-                result = (exp(-q * T) * norm.pdf(d1)) / (S_0 * sigma * sqrt(T))
+                result = (df_q * norm.pdf(d1)) / (S_0 * sigma * sqrt(T))
             else:
-                result = (exp(-q * T) * norm.pdf(d1)) / (S_0 * sigma * sqrt(T))
+                result = (df_q * norm.pdf(d1)) / (S_0 * sigma * sqrt(T))
 
         else:
             raise Exception("Unsupported option type")
@@ -109,21 +360,16 @@ class BlackScholesModel(object):
         if option.option_style == FinancialOption.Style.AMERICAN:
             raise Exception("B\S price for American option not implemented yet")
         elif option.option_style == FinancialOption.Style.EUROPEAN:
-            S_0 = option.underlying.spot_price
-            K = option.strike
-            T = option.time_to_expiry
-            r = self.risk_free_rate
-            q = option.underlying.dividend_yield
-            sigma = option.underlying.sigma
+            S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
             d1 = (np.log(S_0 / K) + (r - q + sigma ** 2 / 2) * T) / (sigma * sqrt(T))
             d2 = d1 - sigma * sqrt(T)
 
             if option.option_type == FinancialOption.Type.CALL:
-                result = (-S_0 * norm.pdf(d1) * sigma * exp(-q * T)) / (2 * sqrt(T)) + \
-                         (q * S_0 * norm.cdf(d1) * exp(-q * T)) - (r * K * exp(-r * T) * norm.cdf(d2))
+                result = (-S_0 * norm.pdf(d1) * sigma * df_q) / (2 * sqrt(T)) + \
+                         (q * S_0 * norm.cdf(d1) * df_q) - (r * K * df_r * norm.cdf(d2))
             else:
-                result = (norm.pdf(d1) * exp(-q * T)) / (S_0 * sigma * sqrt(T)) - \
-                         (q * S_0 * norm.cdf(-d1) * exp(-q * T)) + (r * K * exp(-r * T) * norm.cdf(-d2))
+                result = (-S_0 * norm.pdf(d1) * sigma * df_q) / (2 * sqrt(T)) - \
+                         (q * S_0 * norm.cdf(-d1) * df_q) + (r * K * df_r * norm.cdf(-d2))
         else:
             raise Exception("Unsupported option type")
 
@@ -133,18 +379,13 @@ class BlackScholesModel(object):
         if option.option_style == FinancialOption.Style.AMERICAN:
             raise Exception("B\S price for American option not implemented yet")
         elif option.option_style == FinancialOption.Style.EUROPEAN:
-            S_0 = option.underlying.spot_price
-            K = option.strike
-            T = option.time_to_expiry
-            r = self.risk_free_rate
-            q = option.underlying.dividend_yield
-            sigma = option.underlying.sigma
+            S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
             d1 = (np.log(S_0 / K) + (r - q + sigma ** 2 / 2) * T) / (sigma * sqrt(T))
 
             if option.option_type == FinancialOption.Type.CALL:
-                result = S_0 * sqrt(T) * norm.pdf(d1) * exp(-q * T) 
+                result = S_0 * sqrt(T) * norm.pdf(d1) * df_q 
             else:
-                result = S_0 * sqrt(T) * norm.pdf(d1) * exp(-q * T)
+                result = S_0 * sqrt(T) * norm.pdf(d1) * df_q
 
         else:
             raise Exception("Unsupported option type")
@@ -155,18 +396,14 @@ class BlackScholesModel(object):
         if option.option_style == FinancialOption.Style.AMERICAN:
             raise Exception("B\S price for American option not implemented yet")
         elif option.option_style == FinancialOption.Style.EUROPEAN:
-            S_0 = option.underlying.spot_price
-            K = option.strike
-            T = option.time_to_expiry
-            r = self.risk_free_rate
-            sigma = option.underlying.sigma
+            S_0, K, T, r, q, sigma, df_r, df_q = self.get_market_inputs(option)
             d1 = (np.log(S_0 / K) + (r - q + sigma ** 2 / 2) * T) / (sigma * sqrt(T))
             d2 = d1 - sigma * sqrt(T)
 
             if option.option_type == FinancialOption.Type.CALL:
-                result = K * T * exp(-r * T) * norm.cdf(d2)
+                result = K * T * df_r * norm.cdf(d2)
             else:
-                result = -K * T * exp(-r * T) * norm.cdf(-d2)
+                result = -K * T * df_r * norm.cdf(-d2)
 
         else:
             raise Exception("Unsupported option type")
@@ -197,6 +434,20 @@ def _test():
     put_price = model.calc_model_price(put_option)
     print("Calculated Put Option Price:", put_price)
 
+    # price a chain off a volatility surface with a smile instead of the flat sigma
+    surface = VolatilitySurface.from_strikes('Test', 42, [30, 35, 40, 45, 50], [0.25, 0.5, 1.0],
+                                             [[0.30, 0.25, 0.21, 0.20, 0.22],
+                                              [0.28, 0.24, 0.21, 0.20, 0.21],
+                                              [0.26, 0.23, 0.21, 0.20, 0.20]])
+    model.set_vol_surface(surface)
+    chain = [EuropeanCallOption(stock, time_to_expiry=0.5, strike=k) for k in range(30, 51, 5)]
+    print("Calculated Call Chain Prices with smile:", model.calc_model_prices(chain))
+
+    # use a yield curve and a discrete dividend schedule instead of the flat rate and yield
+    model.yield_curve = YieldCurve([0.25, 0.5, 1.0], [0.09, 0.1, 0.105])
+    model.set_dividend_curve(DividendCurve('Test', dividends=[(0.2, 0.5)]))
+    print("Calculated Call Chain Prices with curves:", model.calc_model_prices(chain))
+
     pass
 
 if __name__ == "__main__":
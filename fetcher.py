@@ -54,12 +54,7 @@ class Fetcher(object):
 
         pass
         
-    def csv_to_table(self, csv_file_name, fields_map, db_table):
-        
-        # insert data from a csv file to a table
-        df = pd.read_csv(csv_file_name)
-        if df.shape[0] <= 0:
-            return
+    def _prepare_frame(self, df, fields_map):
         # change the column header
         df.columns = [fields_map[x] for x in df.columns]
 
@@ -72,21 +67,23 @@ class Fetcher(object):
         # drop the StockSplits column
         new_df.drop(['StockSplits'], axis=1, inplace=True)
         # insert a TurnOver column with zero
-        new_df.insert(loc = new_df.shape[1] - 1, column = 'TurnOver', value = [0] * new_df.shape[0])
-        #print(new_df.head())
+        new_df.insert(loc = new_df.shape[1] - 1, column = 'TurnOver', value = 0)
+        return(new_df)
+
+    def csv_to_table(self, csv_file_name, fields_map, db_table, chunksize = None):
+
+        # insert data from a csv file to a table
+        # with a chunksize the file is read and inserted chunksize rows at a time so the
+        # memory used is bounded by the chunk size whatever the size of the file
+        if chunksize is None:
+            chunks = [pd.read_csv(csv_file_name)]
+        else:
+            chunks = pd.read_csv(csv_file_name, chunksize = chunksize)
 
         ticker = os.path.basename(csv_file_name).replace('.csv','').replace("_daily", "")
         print(ticker)
         cursor = self.db_connection.cursor()
 
-        # Delete old data for the ticker
-        sql_delete = f"DELETE FROM {db_table} WHERE Ticker = '{ticker}'"
-        #print(sql_delete)
-        cursor.execute(sql_delete)
-        
-        #print(new_df)
-        data = new_df.values.tolist()
-
         # changed using AP.py to not use data_tuples. data_tuples worked but this is cleaner/simpler code
         # Insert new data with IGNORE clause to handle duplicates
         sql_insert = f"INSERT OR REPLACE INTO {db_table} (Ticker, AsOfDate, Open, High, Low, Close, Volume, TurnOver, Dividend) "
@@ -94,15 +91,35 @@ class Fetcher(object):
         #print(sql_insert)
 
         try:
-            cursor.executemany(sql_insert, data)
+            num_rows = 0
+            for df in chunks:
+                if df.shape[0] <= 0:
+                    continue
+                new_df = self._prepare_frame(df, fields_map)
+
+                if num_rows == 0:
+                    # Delete old data for the ticker
+                    sql_delete = f"DELETE FROM {db_table} WHERE Ticker = '{ticker}'"
+                    #print(sql_delete)
+                    cursor.execute(sql_delete)
+
+                # rows are fed to executemany by a generator instead of a list of lists
+                cursor.executemany(sql_insert, new_df.itertuples(index = False, name = None))
+                num_rows += new_df.shape[0]
+
+            if num_rows <= 0:
+                cursor.close()
+                return
+
             self.db_connection.commit()
             # Close the cursor and database connection
             cursor.close()
             # Print that data successfully inserted
-            print("Data inserted successfully!")
+            print(f"Data inserted successfully! ({num_rows} rows)")
         except Exception as e:
+            self.db_connection.rollback()
             print(f"Failed in uploading {ticker} because {e}")
-        
+
     def save_daily_data_to_sqlite(self, daily_file_dir, list_of_tickers):
 
         # read all daily.csv files from a dir and load them into sqlite table
@@ -116,7 +133,7 @@ class Fetcher(object):
         for ticker in list_of_tickers:
             file_name = os.path.join(daily_file_dir, f"{ticker}_daily.csv")
             #print(file_name)
-            self.csv_to_table(file_name, fields_map, db_table)
+            self.csv_to_table(file_name, fields_map, db_table, self.opt.chunksize)
 
         #close the db connection
         sqlite3.connect(db_file).close()
@@ -151,12 +168,11 @@ def run():
     
     parser = option.get_default_parser()
     parser.add_argument('--data_dir', dest = 'data_dir', default='./data', help='data dir')    
+    parser.add_argument('--chunksize', dest = 'chunksize', type = int, default = None, help='rows per chunk when loading csv files')
     
     args = parser.parse_args()
     opt = option.Option(args = args)
-
-    opt.output_dir = os.path.join(opt.data_dir, "daily")
-    opt.sqlite_db = os.path.join(opt.data_dir, "sqlitedb/Equity.db")
+    option.set_data_paths(opt)
     
     if opt.tickers is not None:
         list_of_tickers = opt.tickers.split(',')
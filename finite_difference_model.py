@@ -0,0 +1,268 @@
+'''
+
+Finite Difference Model
+
+'''
+
+import math
+import datetime
+import numpy as np
+from scipy.linalg import solve_banded
+from scipy.optimize import brentq
+
+from stock import Stock
+from financial_option import *
+from blackscholes_model import BlackScholesModel, bs_price
+
+
+class FiniteDifferenceModel(BlackScholesModel):
+    '''
+    Crank-Nicolson finite difference solver of the Black-Scholes PDE for European and American options
+    early exercise is handled with a penalty method, the first time steps are fully implicit to damp
+    the oscillations from the non-smooth payoff
+
+    the price is homogeneous in spot and strike, V(S, K) = K * v(S / K), so the PDE is solved once
+    for a unit strike on a grid in log moneyness y = log(S / K) and every strike of a chain sharing the
+    same underlying, expiry, rates, vol, type and style is read off that one grid
+    the grid step is set by vol and expiry alone, a chain with a wider range of strikes gets more nodes
+    rather than a coarser grid
+    market inputs (yield curve, dividend curves, vol surfaces) are the same as for BlackScholesModel
+    vega and rho are central differences of grid solves with the vol or the rates bumped, on the grid
+    of the unbumped inputs so that the difference is not swamped by a change of grid
+    '''
+
+    # bumps of sigma and of the zero rates for vega and rho
+    vol_bump = 1e-3
+    rate_bump = 1e-4
+
+    def __init__(self, pricing_date, risk_free_rate, num_space_steps=800, num_time_steps=200,
+                 num_implicit_steps=2, penalty=1e8, **kwargs):
+        BlackScholesModel.__init__(self, pricing_date, risk_free_rate, **kwargs)
+        self.num_space_steps = num_space_steps
+        self.num_time_steps = num_time_steps
+        self.num_implicit_steps = num_implicit_steps
+        self.penalty = penalty
+
+    def calc_model_price(self, option):
+        return(float(self.calc_model_greeks([option])['price'][0]))
+
+    def calc_delta(self, option):
+        return(float(self.calc_model_greeks([option])['delta'][0]))
+
+    def calc_gamma(self, option):
+        return(float(self.calc_model_greeks([option])['gamma'][0]))
+
+    def calc_theta(self, option):
+        return(float(self.calc_model_greeks([option])['theta'][0]))
+
+    def calc_vega(self, option):
+        return(float(self.calc_model_vegas([option])[0]))
+
+    def calc_rho(self, option):
+        return(float(self.calc_model_rhos([option])[0]))
+
+    def calc_model_prices(self, options):
+        return(self.calc_model_greeks(options)['price'])
+
+    def calc_model_vegas(self, options):
+        up = self.calc_model_greeks(options, sigma_shift=self.vol_bump)['price']
+        down = self.calc_model_greeks(options, sigma_shift=-self.vol_bump)['price']
+        return((up - down) / (2 * self.vol_bump))
+
+    def calc_model_rhos(self, options):
+        # sensitivity to a parallel shift of the zero rates, the PV of discrete dividends is not bumped
+        up = self.calc_model_greeks(options, rate_shift=self.rate_bump)['price']
+        down = self.calc_model_greeks(options, rate_shift=-self.rate_bump)['price']
+        return((up - down) / (2 * self.rate_bump))
+
+    def calc_parity_price(self, option, option_price):
+        '''
+        Put-Call Parity only holds for European options, with early exercise it is only a bound
+        '''
+        if option.option_style == FinancialOption.Style.AMERICAN:
+            raise Exception("Put-Call Parity does not hold for American options")
+        return(BlackScholesModel.calc_parity_price(self, option, option_price))
+
+    def calc_implied_vol(self, option, option_price, lower=1e-4, upper=5.0, tol=1e-8):
+        '''
+        Calculate the vol that reproduces the option price on the finite difference grid
+        return nan if the price is outside the prices at the lower and upper vols
+        '''
+        def price_error(sigma):
+            return(self.calc_model_greeks([option], sigma=sigma)['price'][0] - option_price)
+
+        lower_error = price_error(lower)
+        upper_error = price_error(upper)
+        if lower_error * upper_error > 0:
+            return(float('nan'))
+        return(float(brentq(price_error, lower, upper, xtol=tol)))
+
+    def calc_model_greeks(self, options, sigma_shift=0.0, rate_shift=0.0, sigma=None):
+        '''
+        Calculate price, delta, gamma and theta of a list of options with one PDE solve per grid
+        return a dict of arrays with keys price, delta, gamma and theta
+        sigma_shift and rate_shift bump the vol and the zero rates of the solve but not its grid,
+        sigma replaces the market vol of every option
+        '''
+        n = len(options)
+        result = {k: np.full(n, np.nan) for k in ['price', 'delta', 'gamma', 'theta']}
+        K = np.array([o.strike for o in options], dtype=float)
+        x = np.zeros(n)
+
+        groups = {}
+        for i, o in enumerate(options):
+            S_0, strike, T, r, q, market_sigma, df_r, df_q = self.get_market_inputs(o)
+            x[i] = S_0 / strike
+            key = (o.underlying.ticker, S_0, T, r, q, market_sigma if sigma is None else sigma,
+                   o.option_type == FinancialOption.Type.CALL, o.option_style == FinancialOption.Style.AMERICAN)
+            groups.setdefault(key, []).append(i)
+
+        for key, idx in groups.items():
+            _, S_0, T, r, q, group_sigma, is_call, is_american = key
+            y = self.get_grid(T, r, q, group_sigma, x_min=x[idx].min(), x_max=x[idx].max())
+            grid = self.solve_grid(T, r + rate_shift, q, group_sigma + sigma_shift, is_call, is_american, y)
+            result['price'][idx] = K[idx] * np.interp(x[idx], grid['x'], grid['value'])
+            result['delta'][idx] = np.interp(x[idx], grid['x'], grid['delta'])
+            result['gamma'][idx] = np.interp(x[idx], grid['x'], grid['gamma']) / K[idx]
+            result['theta'][idx] = K[idx] * np.interp(x[idx], grid['x'], grid['theta'])
+
+        return(result)
+
+    def get_grid(self, T, r, q, sigma, x_min=1.0, x_max=1.0):
+        '''
+        return a uniform grid in y = log(S / K) covering x_min to x_max = S / K
+        num_space_steps steps span five standard deviations (plus the drift) either side of a spot,
+        the grid is extended by whole steps beyond the lowest and highest spot so that the strike
+        y = 0 falls on a grid node
+        '''
+        width = 5 * sigma * math.sqrt(T) + abs(r - q - 0.5 * sigma ** 2) * T
+        dy = 2 * width / self.num_space_steps
+        num_lo = int(math.ceil((width - min(math.log(x_min), 0)) / dy))
+        num_hi = int(math.ceil((width + max(math.log(x_max), 0)) / dy))
+        return(dy * np.arange(-num_lo, num_hi + 1))
+
+    def solve_grid(self, T, r, q, sigma, is_call, is_american, y=None):
+        '''
+        solve the PDE for a unit strike on the grid y (by default get_grid for a spot at the strike)
+        return a dict of arrays y, x, value, delta, gamma, theta for the unit strike option
+        '''
+        if y is None:
+            y = self.get_grid(T, r, q, sigma)
+        M = len(y) - 1
+        dy = y[1] - y[0]
+        x = np.exp(y)
+        dt = T / self.num_time_steps
+
+        payoff = np.maximum(x - 1, 0) if is_call else np.maximum(1 - x, 0)
+
+        # in y the coefficients are constant, L v = a v[i-1] + b v[i] + c v[i+1] for the interior nodes
+        mu = r - q - 0.5 * sigma ** 2
+        a = np.full(M - 1, 0.5 * sigma ** 2 / dy ** 2 - 0.5 * mu / dy)
+        b = np.full(M - 1, -sigma ** 2 / dy ** 2 - r)
+        c = np.full(M - 1, 0.5 * sigma ** 2 / dy ** 2 + 0.5 * mu / dy)
+
+        v = payoff.copy()
+        v_prev = v
+        active = np.zeros(M - 1, dtype=bool)
+        for n in range(1, self.num_time_steps + 1):
+            tau = n * dt
+            theta = 1.0 if n <= self.num_implicit_steps else 0.5
+            lo_bc, hi_bc = self._boundary_values(x[0], x[-1], tau, r, q, is_call, is_american)
+
+            rhs = v[1:-1] + (1 - theta) * dt * (a * v[:-2] + b * v[1:-1] + c * v[2:])
+            rhs[0] += theta * dt * a[0] * lo_bc
+            rhs[-1] += theta * dt * c[-1] * hi_bc
+
+            # banded form of (I - theta * dt * L) for solve_banded
+            ab = np.zeros((3, M - 1))
+            ab[0, 1:] = -theta * dt * c[:-1]
+            ab[1, :] = 1 - theta * dt * b
+            ab[2, :-1] = -theta * dt * a[1:]
+
+            interior = solve_banded((1, 1), ab, rhs)
+            if is_american:
+                interior, active = self._apply_penalty(ab, rhs, interior, payoff[1:-1], active)
+
+            v_prev = v
+            v = np.concatenate([[lo_bc], interior, [hi_bc]])
+
+        grid = {'y': y, 'x': x, 'value': v}
+        # dv/dx = v_y / x and d2v/dx2 = (v_yy - v_y) / x^2
+        v_y = np.gradient(v, dy)
+        grid['delta'] = v_y / x
+        gamma = np.zeros_like(v)
+        gamma[1:-1] = ((v[2:] - 2 * v[1:-1] + v[:-2]) / dy ** 2 - v_y[1:-1]) / x[1:-1] ** 2
+        grid['gamma'] = gamma
+        # theta is the change in value as calendar time passes, i.e. minus the change in time to expiry
+        grid['theta'] = -(v - v_prev) / dt
+        return(grid)
+
+    def _apply_penalty(self, ab, rhs, interior, payoff, active):
+        # penalty iteration, nodes below the exercise value are pushed onto it until the set is stable
+        # the exercise region of the previous time step is used as the starting guess
+        exercisable = payoff > 0
+        active = (active | (interior < payoff)) & exercisable
+        for _ in range(20):
+            ab_p = ab.copy()
+            ab_p[1] += self.penalty * active
+            interior = solve_banded((1, 1), ab_p, rhs + self.penalty * active * payoff)
+            new_active = (interior < payoff) & exercisable
+            if np.array_equal(new_active, active):
+                break
+            active = new_active
+        return(interior, active)
+
+    def _boundary_values(self, x_lo, x_hi, tau, r, q, is_call, is_american):
+        # values at x = x_lo and x = x_hi for a unit strike with tau years to expiry, deep in and
+        # out of the money the option is worth its forward intrinsic value (or zero)
+        df_r = math.exp(-r * tau)
+        df_q = math.exp(-q * tau)
+        if is_call:
+            hi = max(x_hi * df_q - df_r, 0.0)
+            if is_american:
+                hi = max(hi, x_hi - 1)
+            return(0.0, hi)
+        else:
+            lo = max(df_r - x_lo * df_q, 0.0)
+            if is_american:
+                lo = max(lo, 1 - x_lo)
+            return(lo, 0.0)
+
+
+def _test():
+    pricing_date = datetime.datetime.now()
+    risk_free_rate = 0.1
+
+    bs_model = BlackScholesModel(pricing_date, risk_free_rate)
+    fd_model = FiniteDifferenceModel(pricing_date, risk_free_rate)
+
+    stock = Stock(opt=None, db_connection=None, ticker='Test', spot_price=42, sigma=0.2)
+
+    call_option = EuropeanCallOption(stock, time_to_expiry=0.5, strike=40)
+    put_option = EuropeanPutOption(stock, time_to_expiry=0.5, strike=40)
+    for o in [call_option, put_option]:
+        print(f"{o.option_type.value} B\\S price: {bs_model.calc_model_price(o):.6f}, FD price: {fd_model.calc_model_price(o):.6f}")
+        print(f"  B\\S delta/gamma/theta: {bs_model.calc_delta(o):.6f} {bs_model.calc_gamma(o):.6f} {bs_model.calc_theta(o):.6f}")
+        print(f"  FD  delta/gamma/theta: {fd_model.calc_delta(o):.6f} {fd_model.calc_gamma(o):.6f} {fd_model.calc_theta(o):.6f}")
+        print(f"  B\\S vega/rho: {bs_model.calc_vega(o):.6f} {bs_model.calc_rho(o):.6f}, FD vega/rho: {fd_model.calc_vega(o):.6f} {fd_model.calc_rho(o):.6f}")
+        print(f"  FD implied vol of the B\\S price: {fd_model.calc_implied_vol(o, bs_model.calc_model_price(o)):.6f}")
+
+    # the grid step does not depend on the strikes of the chain, so wide chains and high vol x expiry
+    # should stay close to B\S
+    for sigma, T in [(0.2, 0.5), (0.5, 2.0), (0.8, 3.0), (1.0, 5.0)]:
+        wide_stock = Stock(opt=None, db_connection=None, ticker='Wide', spot_price=100, sigma=sigma)
+        strikes = np.arange(20, 201, 10, dtype=float)
+        for option_class, is_call in [(EuropeanCallOption, True), (EuropeanPutOption, False)]:
+            fd_prices = fd_model.calc_model_prices([option_class(wide_stock, T, k) for k in strikes])
+            bs_prices = bs_price(100, strikes, T, risk_free_rate, 0, sigma, is_call)
+            print(f"sigma {sigma} T {T} {'call' if is_call else 'put'} chain, max FD - B\\S error: {np.abs(fd_prices - bs_prices).max():.6f}")
+
+    # a whole American put chain costs a single grid solve
+    chain = [AmericanPutOption(stock, time_to_expiry=0.5, strike=k) for k in range(30, 55, 5)]
+    print("American put chain prices:", fd_model.calc_model_prices(chain))
+    print("American put chain vegas:", fd_model.calc_model_vegas(chain))
+    print("American put chain rhos:", fd_model.calc_model_rhos(chain))
+    print("European put chain prices:", bs_model.calc_model_prices([EuropeanPutOption(stock, 0.5, k) for k in range(30, 55, 5)]))
+
+if __name__ == "__main__":
+    _test()
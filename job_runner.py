@@ -0,0 +1,349 @@
+'''
+
+Config driven batch job runner for the fetch, load, analytics and pricing stages
+
+'''
+
+import os
+import copy
+import json
+import time
+import queue
+import hashlib
+import sqlite3
+import datetime
+import contextlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+import option
+from stock import Stock
+from fetcher import Fetcher
+from financial_option import *
+from backtester import load_close_prices
+from blackscholes_model import BlackScholesModel
+from finite_difference_model import FiniteDifferenceModel
+from portfolio_valuation import PortfolioValuation
+
+
+class SQLiteConnectionPool(object):
+    '''
+    Fixed size pool of SQLite connections shared by the stages and their worker threads
+    '''
+
+    def __init__(self, db_file, pool_size = 4, timeout = 30):
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok = True)
+        self.db_file = db_file
+        self._pool = queue.Queue()
+        self._connections = []
+        for _ in range(pool_size):
+            db_connection = sqlite3.connect(db_file, timeout = timeout, check_same_thread = False)
+            self._connections.append(db_connection)
+            self._pool.put(db_connection)
+
+    @contextlib.contextmanager
+    def connection(self):
+        db_connection = self._pool.get()
+        try:
+            yield db_connection
+        finally:
+            self._pool.put(db_connection)
+
+    def close(self):
+        for db_connection in self._connections:
+            db_connection.close()
+
+
+class JobRunner(object):
+    '''
+    Run the stages listed in a job file, e.g.
+    {"name": "sp500_daily", "data_dir": "./data", "universe": {"file": "S&P500.txt"},
+     "start_date": "2020-01-01", "end_date": "2024-01-01",
+     "stages": [{"name": "fetch", "concurrency": 8}, {"name": "load", "chunksize": 100000},
+                {"name": "analytics"}, {"name": "pricing", "engine": "blackscholes", "processes": 4}]}
+    settings missing from the file are taken from _default_job and _default_stages
+    '''
+
+    _default_job = { 'name': 'job', 'data_dir': './data',
+                     'universe': {'tickers': None, 'file': 'S&P500.txt'},
+                     'start_date': '2013-01-01', 'end_date': '2024-01-01',
+                     'sqlite': {'pool_size': 4, 'timeout': 30},
+                     'cache': {'downloads': True, 'prices': True},
+                     'stages': []
+                    }
+
+    _default_stages = { 'fetch': {'concurrency': 8},
+                        'load': {'concurrency': 1, 'chunksize': None},
+                        'analytics': {'concurrency': 4, 'vol_window': 21},
+                        'pricing': {'engine': 'blackscholes', 'processes': 1, 'risk_free_rate': 0.05,
+                                    'style': 'European', 'moneyness': [0.9, 1.0, 1.1], 'expiries': [0.25, 0.5, 1.0]}
+                       }
+
+    def __init__(self, job, opt = None):
+        self.job = self._merge(JobRunner._default_job, job)
+        for stage in self.job['stages']:
+            if stage.get('name') not in JobRunner._default_stages:
+                raise Exception(f"Unknown stage {stage.get('name')} in job {self.job['name']}")
+            if stage['name'] == 'pricing':
+                self._check_pricing(self._merge(JobRunner._default_stages['pricing'], stage))
+
+        # an Option instance carries the job settings to Fetcher and Stock
+        self.opt = opt if opt is not None else option.Option(name = self.job['name'])
+        self.opt.start_date = self.job['start_date']
+        self.opt.end_date = self.job['end_date']
+        option.set_data_paths(self.opt, self.job['data_dir'])
+        self.opt.report_dir = os.path.join(self.opt.data_dir, "output")
+
+        self.tickers = self._get_universe()
+        self.timings = []
+        # results shared between stages
+        self.close_df = None
+        self.analytics_df = None
+        self.pricing_df = None
+
+    def _check_pricing(self, settings):
+        # reject engine, style and processes combinations the pricing stage cannot run
+        engine, style = settings['engine'], settings['style']
+        if engine not in ('blackscholes', 'finite_difference'):
+            raise Exception(f"Unsupported pricing engine {engine}")
+        if style not in [s.value for s in FinancialOption.Style]:
+            raise Exception(f"Unsupported option style {style}")
+        if engine == 'blackscholes' and style == FinancialOption.Style.AMERICAN.value:
+            raise Exception("The blackscholes engine cannot price American options, use finite_difference")
+        if engine == 'finite_difference' and settings['processes'] > 1:
+            raise Exception("The finite_difference engine runs in a single process, set processes to 1")
+
+    @classmethod
+    def from_file(cls, job_file, opt = None):
+        with open(job_file) as f:
+            return(cls(json.load(f), opt))
+
+    def _merge(self, defaults, overrides):
+        result = copy.deepcopy(defaults)
+        for k, v in overrides.items():
+            if isinstance(v, dict) and isinstance(result.get(k), dict):
+                result[k] = self._merge(result[k], v)
+            else:
+                result[k] = v
+        return(result)
+
+    def _get_universe(self):
+        universe = self.job['universe']
+        if getattr(self.opt, 'tickers', None) is not None:
+            return(self.opt.tickers.split(','))
+        if universe['tickers'] is not None:
+            return(list(universe['tickers']))
+        fname = os.path.join(self.opt.data_dir, universe['file'])
+        return(list(pd.read_csv(fname, header=None).iloc[:, 0]))
+
+    def run(self):
+        print(f"Running job {self.job['name']} for {len(self.tickers)} tickers from {self.opt.start_date} to {self.opt.end_date}")
+        pool = SQLiteConnectionPool(self.opt.sqlite_db, self.job['sqlite']['pool_size'], self.job['sqlite']['timeout'])
+        try:
+            for stage in self.job['stages']:
+                settings = self._merge(JobRunner._default_stages[stage['name']], stage)
+                start = time.time()
+                try:
+                    num_items, failures = getattr(self, f"run_{stage['name']}")(settings, pool)
+                    status = 'ok'
+                except Exception as e:
+                    # a failed stage is reported and the job moves on to the next stage
+                    num_items, failures = 0, []
+                    status = f"failed: {e}"
+                    print(f"Stage {stage['name']} failed because {e}")
+                self.timings.append({'stage': stage['name'], 'seconds': time.time() - start,
+                                     'items': num_items, 'failures': len(failures), 'status': status})
+                for ticker, e in failures:
+                    print(f"Stage {stage['name']} failed for {ticker} because {e}")
+        finally:
+            pool.close()
+
+        report = pd.DataFrame(self.timings)
+        print(f"\nTiming report for job {self.job['name']}")
+        print(report.to_string(index = False))
+        return(report)
+
+    def _map(self, func, items, concurrency):
+        # apply func to every item with a thread pool, return the number done and the (item, error) failures
+        failures = []
+        def call(item):
+            try:
+                func(item)
+            except Exception as e:
+                failures.append((item, e))
+
+        if concurrency <= 1:
+            for item in items:
+                call(item)
+        else:
+            with ThreadPoolExecutor(max_workers = concurrency) as executor:
+                list(executor.map(call, items))
+        return(len(items) - len(failures), failures)
+
+    def run_fetch(self, settings, pool):
+        os.makedirs(self.opt.output_dir, exist_ok = True)
+        fetcher = Fetcher(self.opt, None)
+
+        # date range of every downloaded csv, a csv only counts as cached if it covers the job's range
+        ranges_file = os.path.join(self.opt.cache_dir, "download_ranges.json")
+        ranges = {}
+        if os.path.exists(ranges_file):
+            with open(ranges_file) as f:
+                ranges = json.load(f)
+        start_date, end_date = str(self.opt.start_date), str(self.opt.end_date)
+
+        def is_cached(ticker):
+            if not os.path.exists(os.path.join(self.opt.output_dir, f"{ticker}_daily.csv")):
+                return(False)
+            cached_start, cached_end = ranges.get(ticker, (None, None))
+            return(cached_start is not None and cached_start <= start_date and cached_end >= end_date)
+
+        tickers = self.tickers
+        if self.job['cache']['downloads'] and not self.opt.force:
+            tickers = [t for t in tickers if not is_cached(t)]
+            print(f"Downloading {len(tickers)} tickers, {len(self.tickers) - len(tickers)} already cached")
+
+        def fetch(ticker):
+            fetcher.download_data_to_csv([ticker])
+            # an empty download is written as a header only csv, it is a failure and is not cached
+            if len(pd.read_csv(os.path.join(self.opt.output_dir, f"{ticker}_daily.csv"), nrows = 1)) == 0:
+                raise Exception("no data downloaded")
+
+        num_items, failures = self._map(fetch, tickers, settings['concurrency'])
+
+        failed = set(t for t, _ in failures)
+        ranges.update({t: [start_date, end_date] for t in tickers if t not in failed})
+        os.makedirs(self.opt.cache_dir, exist_ok = True)
+        with open(ranges_file, 'w') as f:
+            json.dump(ranges, f)
+        return(num_items, failures)
+
+    def run_load(self, settings, pool):
+        self.opt.chunksize = settings['chunksize']
+
+        def load(ticker):
+            with pool.connection() as db_connection:
+                Fetcher(self.opt, db_connection).save_daily_data_to_sqlite(self.opt.output_dir, [ticker])
+
+        return(self._map(load, self.tickers, settings['concurrency']))
+
+    def run_analytics(self, settings, pool):
+        cache_file = None
+        if self.job['cache']['prices']:
+            # the key includes a fingerprint of the price table so the cache goes stale when load rewrites it
+            with pool.connection() as db_connection:
+                fingerprint = self._get_prices_fingerprint(db_connection)
+            key = hashlib.md5(json.dumps([self.tickers, str(self.opt.start_date), str(self.opt.end_date),
+                                          fingerprint]).encode()).hexdigest()
+            cache_file = os.path.join(self.opt.cache_dir, f"close_{key}.pkl")
+
+        if cache_file is not None and os.path.exists(cache_file) and not self.opt.force:
+            close_df = pd.read_pickle(cache_file)
+            print(f"Read prices from {cache_file}")
+        else:
+            # split the universe into one bulk query per worker
+            num_chunks = max(1, settings['concurrency'])
+            chunks = [c for c in np.array_split(np.array(self.tickers, dtype=object), num_chunks) if len(c) > 0]
+            frames = []
+
+            def load(tickers):
+                with pool.connection() as db_connection:
+                    frames.append(load_close_prices(db_connection, list(tickers), self.opt.start_date, self.opt.end_date))
+
+            _, failures = self._map(load, chunks, settings['concurrency'])
+            if failures:
+                return(0, failures)
+            close_df = pd.concat(frames, axis = 1).sort_index() if frames else pd.DataFrame()
+            if cache_file is not None:
+                os.makedirs(self.opt.cache_dir, exist_ok = True)
+                close_df.to_pickle(cache_file)
+
+        log_returns = np.log(close_df).diff()
+        window = settings['vol_window']
+        self.close_df = close_df
+        self.analytics_df = pd.DataFrame({'spot_price': close_df.ffill().iloc[-1] if len(close_df) else np.nan,
+                                          'sigma': log_returns.iloc[-window:].std() * np.sqrt(252),
+                                          'mean_return': log_returns.mean() * 252,
+                                          'num_days': close_df.count()})
+        self.analytics_df.index.name = 'Ticker'
+        self._save(self.analytics_df, 'analytics')
+
+        missing = [(t, "no price history") for t in self.tickers if t not in close_df.columns]
+        return(close_df.shape[1], missing)
+
+    def _get_prices_fingerprint(self, db_connection):
+        # row count, last date and sum of Close of the universe's prices over the job's date range
+        placeholders = ','.join(['?'] * len(self.tickers))
+        sql = f"select count(*), max(AsOfDate), total(Close) from EquityDailyPrice " \
+              f"where Ticker in ({placeholders}) and substr(AsOfDate, 1, 10) between ? and ?"
+        params = list(self.tickers) + [str(self.opt.start_date), str(self.opt.end_date)]
+        return(list(db_connection.execute(sql, params).fetchone()))
+
+    def run_pricing(self, settings, pool):
+        if self.analytics_df is None:
+            raise Exception("The pricing stage needs the analytics stage to run first")
+
+        pricing_date = datetime.datetime.now()
+        if settings['engine'] == 'finite_difference':
+            model = FiniteDifferenceModel(pricing_date, settings['risk_free_rate'])
+        else:
+            model = BlackScholesModel(pricing_date, settings['risk_free_rate'])
+
+        american = settings['style'] == FinancialOption.Style.AMERICAN.value
+        call_class = AmericanCallOption if american else EuropeanCallOption
+        put_class = AmericanPutOption if american else EuropeanPutOption
+
+        options = []
+        failures = []
+        for ticker, row in self.analytics_df.iterrows():
+            if not (row.spot_price > 0 and row.sigma > 0):
+                failures.append((ticker, "no spot price or vol"))
+                continue
+            stock = Stock(self.opt, None, ticker, spot_price = row.spot_price, sigma = row.sigma)
+            for T in settings['expiries']:
+                for m in settings['moneyness']:
+                    strike = round(row.spot_price * m, 2)
+                    options.append(call_class(stock, T, strike))
+                    options.append(put_class(stock, T, strike))
+
+        if len(options) == 0:
+            return(0, failures)
+
+        if settings['engine'] == 'blackscholes' and settings['processes'] > 1:
+            with PortfolioValuation(model, num_workers = settings['processes']) as valuation:
+                valuation.value([(o, 1) for o in options])
+                greeks = {c: valuation.position_results[c].to_numpy() for c in ['price', 'delta', 'gamma', 'theta']}
+        else:
+            greeks = model.calc_model_greeks(options)
+
+        self.pricing_df = pd.DataFrame({'Ticker': [o.underlying.ticker for o in options],
+                                        'option_type': [o.option_type.value for o in options],
+                                        'option_style': [o.option_style.value for o in options],
+                                        'time_to_expiry': [o.time_to_expiry for o in options],
+                                        'strike': [o.strike for o in options]})
+        for c in ['price', 'delta', 'gamma', 'theta']:
+            self.pricing_df[c] = greeks[c]
+        self._save(self.pricing_df, 'pricing', index = False)
+
+        return(len(options), failures)
+
+    def _save(self, df, stage_name, index = True):
+        os.makedirs(self.opt.report_dir, exist_ok = True)
+        fname = os.path.join(self.opt.report_dir, f"{self.job['name']}_{stage_name}.csv")
+        df.to_csv(fname, index = index)
+        print(f"Saved {stage_name} results to {fname}")
+
+
+def run():
+    parser = option.get_default_parser()
+    parser.add_argument('--job', dest = 'job_file', required = True, help = 'job file (json)')
+
+    args = parser.parse_args()
+    opt = option.Option(args = args)
+
+    runner = JobRunner.from_file(opt.job_file, opt)
+    runner.run()
+
+if __name__ == "__main__":
+    run()
@@ -13,7 +13,8 @@ class Option(object):
     _default_option = { 'environ': 'dev', 'verbose': False,
                         'force': False,
                         'start_date': None, 'end_date': None, 
-                        'tickers': None, 'port_name': None
+                        'tickers': None, 'port_name': None,
+                        'chunksize': None
                        }
 
     def __init__(self, name = None, user = None, args = None):
@@ -51,6 +52,15 @@ def get_default_parser():
     parser.add_argument('--tickers', dest='tickers', default=None, help='Tickers with | separator')
     
     return(parser)
+
+def set_data_paths(opt, data_dir = None):
+    # derive the standard locations under the data dir
+    if data_dir is not None:
+        opt.data_dir = data_dir
+    opt.output_dir = os.path.join(opt.data_dir, "daily")
+    opt.sqlite_db = os.path.join(opt.data_dir, "sqlitedb/Equity.db")
+    opt.cache_dir = os.path.join(opt.data_dir, "cache")
+    return(opt)
             
 def _test():
 
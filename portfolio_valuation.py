@@ -0,0 +1,233 @@
+'''
+
+Multi-process portfolio valuation on top of the Black-Scholes Model
+
+'''
+
+import os
+import time
+import weakref
+import datetime
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from stock import Stock
+from financial_option import *
+from blackscholes_model import BlackScholesModel, bs_greeks
+
+
+class PositionBook(object):
+    '''
+    Columnar book of European option positions
+    tickers, spot_price, sigma and dividend_yield are per underlying, underlying, strike, time_to_expiry,
+    is_call and quantity are per position with underlying indexing into the per underlying arrays
+    '''
+
+    def __init__(self, tickers, spot_price, sigma, dividend_yield, underlying, strike, time_to_expiry, is_call, quantity):
+        self.tickers = list(tickers)
+        self.spot_price = np.asarray(spot_price, dtype=np.float64)
+        self.sigma = np.asarray(sigma, dtype=np.float64)
+        self.dividend_yield = np.asarray(dividend_yield, dtype=np.float64)
+        self.underlying = np.asarray(underlying, dtype=np.intp)
+        self.strike = np.asarray(strike, dtype=np.float64)
+        self.time_to_expiry = np.asarray(time_to_expiry, dtype=np.float64)
+        self.is_call = np.asarray(is_call, dtype=bool)
+        self.quantity = np.asarray(quantity, dtype=np.float64)
+
+    @classmethod
+    def from_positions(cls, positions):
+        '''
+        build the book from a list of (FinancialOption, quantity), underlyings are grouped by ticker
+        '''
+        if any(p[0].option_style == FinancialOption.Style.AMERICAN for p in positions):
+            raise Exception("B\\S price for American option not implemented yet")
+
+        index = {}
+        stocks = []
+        underlying = np.empty(len(positions), dtype=np.intp)
+        for i, p in enumerate(positions):
+            u = index.get(p[0].underlying.ticker)
+            if u is None:
+                u = index[p[0].underlying.ticker] = len(stocks)
+                stocks.append(p[0].underlying)
+            underlying[i] = u
+
+        return(cls([s.ticker for s in stocks], [s.spot_price for s in stocks], [s.sigma for s in stocks],
+                   [s.dividend_yield for s in stocks], underlying,
+                   [p[0].strike for p in positions], [p[0].time_to_expiry for p in positions],
+                   [p[0].option_type == FinancialOption.Type.CALL for p in positions], [p[1] for p in positions]))
+
+    def __len__(self):
+        return(len(self.strike))
+
+
+class PortfolioValuation(object):
+    '''
+    Value a PositionBook with a BlackScholesModel over a pool of worker processes
+    the book columns and the per underlying spot, sigma and dividend yield are placed in shared memory,
+    each worker builds the market inputs of its own chunk from them, so neither the book nor the
+    Stock objects are pickled and no per position work is left in the parent
+    the process pool and the shared blocks are kept between valuations, call close() when done
+    '''
+
+    # rows of the shared position block
+    POSITION_FIELDS = ['underlying', 'strike', 'time_to_expiry', 'is_call', 'quantity']
+    # rows of the shared underlying block
+    UNDERLYING_FIELDS = ['spot_price', 'sigma', 'dividend_yield']
+    # rows of the shared output block, all multiplied by the position quantity
+    OUTPUT_FIELDS = ['price', 'delta', 'gamma', 'theta', 'vega', 'rho']
+
+    def __init__(self, model, num_workers=None, chunk_size=250000):
+        self.model = model
+        self.num_workers = num_workers if num_workers is not None else os.cpu_count()
+        self.chunk_size = chunk_size
+        self.position_results = None
+        self._executor = None
+        self._blocks = {}
+        weakref.finalize(self, _release_blocks, self._blocks)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        _release_blocks(self._blocks)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.num_workers)
+        return(self._executor)
+
+    def _get_block(self, key, num_rows, num_cols):
+        # shared blocks are only reallocated when the book outgrows them, so their pages stay mapped
+        size = max(1, num_rows * num_cols * 8)
+        shm = self._blocks.get(key)
+        if shm is None or shm.size < size:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self._blocks[key] = shm
+        return(shm.name, np.ndarray((num_rows, num_cols), dtype=np.float64, buffer=shm.buf))
+
+    def value(self, book, keep_positions=True):
+        '''
+        return a DataFrame of the portfolio totals per underlying ticker
+        book is a PositionBook or a list of (FinancialOption, quantity)
+        with keep_positions the position level values are kept in self.position_results
+        (a DataFrame in position order)
+        '''
+        if not isinstance(book, PositionBook):
+            book = PositionBook.from_positions(book)
+
+        n = len(book)
+        m = len(book.tickers)
+        pos_name, positions = self._get_block('positions', len(self.POSITION_FIELDS), n)
+        und_name, underlyings = self._get_block('underlyings', len(self.UNDERLYING_FIELDS), m)
+        out_name, outputs = self._get_block('outputs', len(self.OUTPUT_FIELDS), n)
+        for i, field in enumerate(self.POSITION_FIELDS):
+            positions[i] = getattr(book, field)
+        for i, field in enumerate(self.UNDERLYING_FIELDS):
+            underlyings[i] = getattr(book, field)
+
+        chunks = [(start, min(start + self.chunk_size, n)) for start in range(0, n, self.chunk_size)]
+        args = [(self.model, book.tickers, pos_name, und_name, out_name, n, start, end) for start, end in chunks]
+
+        if self.num_workers <= 1 or len(chunks) <= 1:
+            partials = [_value_chunk(*a) for a in args]
+        else:
+            partials = list(self._get_executor().map(_value_chunk, *zip(*args)))
+
+        totals = np.zeros((len(self.OUTPUT_FIELDS), m))
+        for partial in partials:
+            totals += partial
+
+        self.position_results = None
+        if keep_positions:
+            results = {'Ticker': pd.Categorical.from_codes(book.underlying, book.tickers)}
+            for i, field in enumerate(self.OUTPUT_FIELDS):
+                results[field] = outputs[i].copy()
+            self.position_results = pd.DataFrame(results, copy=False)
+
+        del positions, underlyings, outputs
+        return(pd.DataFrame(totals.T, index=pd.Index(book.tickers, name='Ticker'), columns=self.OUTPUT_FIELDS))
+
+
+def _release_blocks(blocks):
+    for shm in blocks.values():
+        shm.close()
+        shm.unlink()
+    blocks.clear()
+
+
+def _value_chunk(model, tickers, pos_name, und_name, out_name, n, start, end):
+    # runs in a worker process: attach to the shared blocks, build the market inputs and value
+    # the [start, end) slice, return the quantity weighted totals per underlying
+    pos_shm = shared_memory.SharedMemory(name=pos_name)
+    und_shm = shared_memory.SharedMemory(name=und_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        m = len(tickers)
+        positions = np.ndarray((len(PortfolioValuation.POSITION_FIELDS), n), dtype=np.float64, buffer=pos_shm.buf)
+        underlyings = np.ndarray((len(PortfolioValuation.UNDERLYING_FIELDS), m), dtype=np.float64, buffer=und_shm.buf)
+        outputs = np.ndarray((len(PortfolioValuation.OUTPUT_FIELDS), n), dtype=np.float64, buffer=out_shm.buf)
+
+        underlying, K, T, is_call, quantity = positions[:, start:end]
+        underlying = underlying.astype(np.intp)
+        spot_price, sigma, dividend_yield = underlyings
+
+        inputs = model.get_market_input_columns(tickers, spot_price, sigma, dividend_yield.tolist(),
+                                                underlying, K, T, is_call > 0)
+        greeks = bs_greeks(*inputs)
+
+        totals = np.zeros((len(PortfolioValuation.OUTPUT_FIELDS), m))
+        for i, field in enumerate(PortfolioValuation.OUTPUT_FIELDS):
+            outputs[i, start:end] = greeks[field] * quantity
+            totals[i] = np.bincount(underlying, weights=outputs[i, start:end], minlength=m)
+
+        del positions, underlyings, outputs, K, T, is_call, quantity, spot_price, sigma, dividend_yield
+        return(totals)
+    finally:
+        pos_shm.close()
+        und_shm.close()
+        out_shm.close()
+
+
+def _test():
+    pricing_date = datetime.datetime.now()
+    model = BlackScholesModel(pricing_date, risk_free_rate=0.05)
+
+    rng = np.random.default_rng(0)
+    num_positions = 2000000
+    tickers = [f'T{i}' for i in range(50)]
+    spot_price = 50 + rng.uniform(0, 100, len(tickers))
+    underlying = rng.integers(len(tickers), size=num_positions)
+    book = PositionBook(tickers, spot_price, rng.uniform(0.15, 0.5, len(tickers)), np.zeros(len(tickers)),
+                        underlying, np.round(spot_price[underlying] * rng.uniform(0.7, 1.3, num_positions)),
+                        rng.choice([0.25, 0.5, 1.0], num_positions), rng.random(num_positions) < 0.5,
+                        rng.integers(-10, 11, num_positions))
+
+    for num_workers in sorted(set([1, os.cpu_count()])):
+        with PortfolioValuation(model, num_workers=num_workers, chunk_size=100000) as valuation:
+            valuation.value(book, keep_positions=False)
+            start = time.time()
+            totals = valuation.value(book, keep_positions=False)
+            print(f"Valued {len(book)} positions with {num_workers} workers in {time.time() - start:.2f}s")
+    print(totals.head())
+
+    # a list of (FinancialOption, quantity) is converted to a PositionBook first
+    stock = Stock(opt=None, db_connection=None, ticker='Test', spot_price=42, sigma=0.2)
+    positions = [(EuropeanCallOption(stock, 0.5, 40), 10), (EuropeanPutOption(stock, 0.5, 40), -5)]
+    with PortfolioValuation(model, num_workers=1) as valuation:
+        print(valuation.value(positions))
+        print(valuation.position_results)
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,136 @@
+'''
+
+Client and load test for the local pricing service
+
+'''
+
+import json
+import time
+import asyncio
+import numpy as np
+
+import option
+
+
+class PricingClient(object):
+    '''
+    Minimal asyncio HTTP/1.1 client keeping one connection open to the pricing service
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8080):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+
+    async def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self._writer.write(f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                           f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await self._writer.drain()
+
+        status = (await self._reader.readline()).decode('latin-1').split(' ', 2)[1]
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        data = await self._reader.readexactly(int(headers.get('content-length', 0)))
+
+        result = json.loads(data)
+        if status != '200':
+            raise Exception(f"Request to {path} failed with {status}: {result}")
+        return(result)
+
+    async def price(self, contracts):
+        return(await self.request('POST', '/price', contracts))
+
+    async def greeks(self, contracts):
+        return(await self.request('POST', '/greeks', contracts))
+
+    async def implied_vol(self, contracts):
+        return(await self.request('POST', '/implied_vol', contracts))
+
+    async def stats(self):
+        return(await self.request('GET', '/stats'))
+
+
+def random_contract(rng, endpoint):
+    contract = {'option_type': 'Call' if rng.random() < 0.5 else 'Put',
+                'spot_price': 100.0,
+                'strike': float(round(rng.uniform(70, 130))),
+                'time_to_expiry': float(rng.choice([0.25, 0.5, 1.0])),
+                'dividend_yield': 0.01}
+    if endpoint == '/implied_vol':
+        contract['price'] = float(rng.uniform(2, 20))
+    else:
+        contract['sigma'] = float(rng.uniform(0.1, 0.5))
+    return(contract)
+
+
+async def load_test(host, port, endpoint='/price', num_connections=50, num_requests=200, contracts_per_request=1):
+    '''
+    send num_requests requests on each of num_connections concurrent connections
+    and return the client side latencies in seconds
+    '''
+    latencies = []
+
+    async def worker(seed):
+        rng = np.random.default_rng(seed)
+        client = PricingClient(host, port)
+        await client.connect()
+        try:
+            for _ in range(num_requests):
+                contracts = [random_contract(rng, endpoint) for _ in range(contracts_per_request)]
+                start = time.perf_counter()
+                await client.request('POST', endpoint, contracts)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            await client.close()
+
+    await asyncio.gather(*[worker(i) for i in range(num_connections)])
+    return(np.array(latencies))
+
+
+def run():
+    parser = option.get_default_parser()
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='pricing service host')
+    parser.add_argument('--port', dest='port', type=int, default=8080, help='pricing service port')
+    parser.add_argument('--endpoint', dest='endpoint', default='/price', help='/price, /greeks or /implied_vol')
+    parser.add_argument('--connections', dest='connections', type=int, default=50, help='concurrent connections')
+    parser.add_argument('--requests', dest='requests', type=int, default=200, help='requests per connection')
+    parser.add_argument('--contracts', dest='contracts', type=int, default=1, help='contracts per request')
+
+    args = parser.parse_args()
+    opt = option.Option(args = args)
+
+    start = time.time()
+    latencies = asyncio.run(load_test(opt.host, opt.port, opt.endpoint, opt.connections, opt.requests, opt.contracts))
+    elapsed = time.time() - start
+
+    p50, p90, p99 = np.percentile(latencies * 1000, [50, 90, 99])
+    print(f"{len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} req/s)")
+    print(f"Client latency ms p50: {p50:.2f} p90: {p90:.2f} p99: {p99:.2f}")
+
+    async def get_stats():
+        client = PricingClient(opt.host, opt.port)
+        await client.connect()
+        try:
+            return(await client.stats())
+        finally:
+            await client.close()
+
+    print("Server stats:", json.dumps(asyncio.run(get_stats()), indent=2))
+
+if __name__ == "__main__":
+    run()
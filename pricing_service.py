@@ -0,0 +1,288 @@
+'''
+
+Local HTTP/JSON pricing service on top of the Black-Scholes Model
+
+'''
+
+import json
+import time
+import asyncio
+import datetime
+import collections
+import numpy as np
+
+import option
+from blackscholes_model import BlackScholesModel, bs_price, bs_greeks, bs_implied_vol
+
+
+class MicroBatcher(object):
+    '''
+    Collect concurrent requests into one batch and hand it to a vectorized handler
+    a batch is flushed when it holds max_batch_size contracts or its first request has waited max_wait seconds
+    '''
+
+    def __init__(self, handler, max_batch_size=1024, max_wait=0.002):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_batches = 0
+        self.num_contracts = 0
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, columns):
+        # columns is a dict of equal length arrays, one row per contract, the result is a list of dict in the same order
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((columns, future))
+        return(await future)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            size = _num_rows(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += _num_rows(item[0])
+
+            columns = {k: np.concatenate([item[k] for item, _ in batch]) for k in batch[0][0]}
+            try:
+                results = await loop.run_in_executor(None, self.handler, columns)
+            except Exception:
+                # the requests were validated before joining the queue, if the batch still fails
+                # run each request alone so only the one at fault gets the error
+                for item, future in batch:
+                    try:
+                        result = await loop.run_in_executor(None, self.handler, item)
+                    except Exception as e:
+                        if not future.done():
+                            future.set_exception(e)
+                        continue
+                    if not future.done():
+                        future.set_result(result)
+                continue
+
+            self.num_batches += 1
+            self.num_contracts += size
+            start = 0
+            for item, future in batch:
+                if not future.done():
+                    future.set_result(results[start:start + _num_rows(item)])
+                start += _num_rows(item)
+
+
+def _num_rows(columns):
+    return(len(next(iter(columns.values()))))
+
+
+class PricingService(object):
+    '''
+    asyncio HTTP server exposing POST /price, /greeks and /implied_vol and GET /stats
+    the body of a POST is one contract or a list of contracts, e.g.
+    {"option_type": "Call", "spot_price": 42, "strike": 40, "time_to_expiry": 0.5, "sigma": 0.2}
+    dividend_yield is optional and /implied_vol takes "price" instead of "sigma"
+    rates come from the model's yield curve (or its flat risk_free_rate)
+    '''
+
+    def __init__(self, model, host='127.0.0.1', port=8080, max_batch_size=1024, max_wait=0.002, num_latencies=100000):
+        self.model = model
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.latencies = {}
+        self.num_latencies = num_latencies
+        self.num_requests = {}
+        self.num_errors = {}
+        self.batchers = {}
+        self._server = None
+
+    async def start(self):
+        self.batchers = {'/price': MicroBatcher(self._price, self.max_batch_size, self.max_wait),
+                         '/greeks': MicroBatcher(self._greeks, self.max_batch_size, self.max_wait),
+                         '/implied_vol': MicroBatcher(self._implied_vol, self.max_batch_size, self.max_wait)}
+        for path, batcher in self.batchers.items():
+            batcher.start()
+            self.latencies[path] = collections.deque(maxlen=self.num_latencies)
+            self.num_requests[path] = 0
+            self.num_errors[path] = 0
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        print(f"Pricing service listening on http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    def get_stats(self):
+        stats = {}
+        for path, batcher in self.batchers.items():
+            # the latencies are a sample of the last num_latencies successful requests
+            latencies = np.array(self.latencies[path]) * 1000
+            stats[path] = {'requests': self.num_requests[path],
+                           'errors': self.num_errors[path],
+                           'batches': batcher.num_batches,
+                           'contracts': batcher.num_contracts,
+                           'mean_batch_size': batcher.num_contracts / batcher.num_batches if batcher.num_batches else 0}
+            if len(latencies) > 0:
+                p50, p90, p99, p999 = np.percentile(latencies, [50, 90, 99, 99.9])
+                stats[path].update({'latency_ms_p50': p50, 'latency_ms_p90': p90,
+                                    'latency_ms_p99': p99, 'latency_ms_p999': p999,
+                                    'latency_ms_max': float(latencies.max())})
+        return(stats)
+
+    # fields of a contract per endpoint, option_type is read as is_call and dividend_yield is optional
+    _fields = {'/price': ['spot_price', 'strike', 'time_to_expiry', 'dividend_yield', 'sigma'],
+               '/greeks': ['spot_price', 'strike', 'time_to_expiry', 'dividend_yield', 'sigma'],
+               '/implied_vol': ['spot_price', 'strike', 'time_to_expiry', 'dividend_yield', 'price']}
+
+    def _get_columns(self, path, contracts):
+        '''
+        validate the contracts of one request and convert them to a dict of arrays
+        '''
+        if len(contracts) == 0 or not all(isinstance(c, dict) for c in contracts):
+            raise Exception("Request must be a contract or a non-empty list of contracts")
+
+        columns = {}
+        for field in self._fields[path]:
+            try:
+                values = [c.get(field, 0) if field == 'dividend_yield' else c[field] for c in contracts]
+            except KeyError:
+                raise Exception(f"Missing {field} in contract")
+            try:
+                columns[field] = np.array(values, dtype=float)
+            except (TypeError, ValueError):
+                raise Exception(f"{field} must be a number")
+            if columns[field].ndim != 1 or not np.all(np.isfinite(columns[field])):
+                raise Exception(f"{field} must be a finite number")
+            if field != 'dividend_yield' and not np.all(columns[field] > 0):
+                raise Exception(f"{field} must be positive")
+
+        option_types = [str(c.get('option_type', '')).lower() for c in contracts]
+        if any(t not in ('call', 'put') for t in option_types):
+            raise Exception("option_type must be Call or Put")
+        columns['is_call'] = np.array([t == 'call' for t in option_types])
+        return(columns)
+
+    def _get_arrays(self, columns):
+        # discount factors are computed directly, the yield curve cache is not grown with client expiries
+        T = columns['time_to_expiry']
+        r = self.model.get_yield_curve().get_zero_rates(T)
+        return(columns['spot_price'], columns['strike'], T, r, columns['dividend_yield'], columns['is_call'], np.exp(-r * T))
+
+    def _price(self, columns):
+        S_0, K, T, r, q, is_call, df_r = self._get_arrays(columns)
+        px = bs_price(S_0, K, T, r, q, columns['sigma'], is_call, df_r)
+        return([{'price': p} for p in px.tolist()])
+
+    def _greeks(self, columns):
+        S_0, K, T, r, q, is_call, df_r = self._get_arrays(columns)
+        greeks = bs_greeks(S_0, K, T, r, q, columns['sigma'], is_call, df_r)
+        columns = {k: v.tolist() for k, v in greeks.items()}
+        return([{k: columns[k][i] for k in columns} for i in range(len(S_0))])
+
+    def _implied_vol(self, columns):
+        S_0, K, T, r, q, is_call, df_r = self._get_arrays(columns)
+        vols = bs_implied_vol(columns['price'], S_0, K, T, r, q, is_call)
+        return([{'implied_vol': v if np.isfinite(v) else None} for v in vols.tolist()])
+
+    async def _handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, v = line.decode('latin-1').split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self._dispatch(method, path, body)
+                data = json.dumps(payload).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return('200 OK', self.get_stats())
+        if method != 'POST' or path not in self.batchers:
+            return('404 Not Found', {'error': f"Unknown endpoint {method} {path}"})
+
+        start = time.perf_counter()
+        self.num_requests[path] += 1
+        try:
+            request = json.loads(body)
+            columns = self._get_columns(path, request if isinstance(request, list) else [request])
+            results = await self.batchers[path].submit(columns)
+        except Exception as e:
+            self.num_errors[path] += 1
+            return('400 Bad Request', {'error': f"Failed to process request because {e}"})
+        self.latencies[path].append(time.perf_counter() - start)
+
+        return('200 OK', results if isinstance(request, list) else results[0])
+
+
+def run():
+    parser = option.get_default_parser()
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('--port', dest='port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--risk_free_rate', dest='risk_free_rate', type=float, default=0.05, help='flat risk free rate')
+    parser.add_argument('--max_batch_size', dest='max_batch_size', type=int, default=1024, help='max contracts per batch')
+    parser.add_argument('--max_wait_ms', dest='max_wait_ms', type=float, default=2.0, help='max wait to fill a batch (ms)')
+
+    args = parser.parse_args()
+    opt = option.Option(args = args)
+
+    model = BlackScholesModel(datetime.datetime.now(), opt.risk_free_rate)
+    service = PricingService(model, opt.host, opt.port, opt.max_batch_size, opt.max_wait_ms / 1000)
+    try:
+        asyncio.run(service.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    run()
@@ -174,9 +174,7 @@ def _test():
     
     args = parser.parse_args()
     opt = option.Option(args = args)
-
-    opt.output_dir = os.path.join(opt.data_dir, "daily")
-    opt.sqlite_db = os.path.join(opt.data_dir, "sqlitedb/Equity.db")
+    option.set_data_paths(opt)
 
     db_file = opt.sqlite_db
     db_connection = sqlite3.connect(db_file)
@@ -0,0 +1,171 @@
+'''
+
+Yield curve and dividend curve with cached discount factors
+
+'''
+
+import math
+import weakref
+import numpy as np
+
+
+class YieldCurve(object):
+    '''
+    Zero rate curve, rates are continuously compounded and tenors are expressed in unit of years
+    rates are linearly interpolated between tenors and flat outside them
+    discount factors are cached for the expiries given to precompute (e.g. the listed expiries) so all
+    contracts sharing them reuse them, other expiries are computed directly and the cache stays bounded
+    '''
+
+    def __init__(self, tenors, zero_rates):
+        self.tenors = np.asarray(tenors, dtype=float)
+        self.zero_rates = np.asarray(zero_rates, dtype=float)
+        if len(self.tenors) != len(self.zero_rates) or len(self.tenors) == 0:
+            raise Exception("Tenors and zero rates must be non-empty and of the same length")
+        if np.any(np.diff(self.tenors) <= 0):
+            raise Exception("Tenors must be strictly increasing")
+
+        self._discount_factors = {}
+
+    @classmethod
+    def flat(cls, rate):
+        return(cls([1.0], [rate]))
+
+    def get_zero_rate(self, time_to_expiry):
+        return(float(np.interp(time_to_expiry, self.tenors, self.zero_rates)))
+
+    def get_discount_factor(self, time_to_expiry):
+        df = self._discount_factors.get(time_to_expiry)
+        if df is None:
+            df = math.exp(-self.get_zero_rate(time_to_expiry) * time_to_expiry)
+        return(df)
+
+    def precompute(self, expiries):
+        '''
+        fill the cache for a set of expiries in one vectorized pass
+        '''
+        expiries = np.unique(np.asarray(expiries, dtype=float))
+        expiries = expiries[[t not in self._discount_factors for t in expiries.tolist()]]
+        if len(expiries) > 0:
+            dfs = np.exp(-np.interp(expiries, self.tenors, self.zero_rates) * expiries)
+            self._discount_factors.update(zip(expiries.tolist(), dfs.tolist()))
+
+    def get_discount_factors(self, times_to_expiry):
+        '''
+        vectorized discount factors, only one exponential per distinct expiry that is not cached
+        '''
+        times_to_expiry = np.asarray(times_to_expiry, dtype=float)
+        expiries, inverse = np.unique(times_to_expiry, return_inverse=True)
+        dfs = _lookup(self._discount_factors, expiries,
+                      lambda t: np.exp(-np.interp(t, self.tenors, self.zero_rates) * t))
+        return(dfs[inverse].reshape(times_to_expiry.shape))
+
+    def get_zero_rates(self, times_to_expiry):
+        return(np.interp(np.asarray(times_to_expiry, dtype=float), self.tenors, self.zero_rates))
+
+
+class DividendCurve(object):
+    '''
+    Dividends of one underlying as a continuous dividend yield and/or a schedule of discrete
+    cash dividends given as (time_to_payment, amount) with time in unit of years
+    discrete dividends are handled by taking their present value off the spot price
+    as for YieldCurve only the expiries given to precompute are cached
+    '''
+
+    def __init__(self, ticker, dividend_yield=0, dividends=None):
+        self.ticker = ticker
+        self.dividend_yield = dividend_yield
+        self.dividends = sorted(dividends) if dividends is not None else []
+
+        self._discount_factors = {}
+        # present values depend on the yield curve, so they are cached per curve
+        self._pv_dividends = weakref.WeakKeyDictionary()
+
+    def __getstate__(self):
+        # the caches are rebuilt on demand, the weak references to yield curves cannot be pickled
+        state = self.__dict__.copy()
+        state['_discount_factors'] = {}
+        state['_pv_dividends'] = None
+        return(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pv_dividends = weakref.WeakKeyDictionary()
+
+    def precompute(self, expiries, yield_curve=None):
+        '''
+        fill the discount factor cache for a set of expiries, and the present values of the
+        discrete dividends on yield_curve if one is given
+        '''
+        expiries = np.unique(np.asarray(expiries, dtype=float))
+        self._discount_factors.update(zip(expiries.tolist(), np.exp(-self.dividend_yield * expiries).tolist()))
+        if yield_curve is not None:
+            cache = self._pv_dividends.get(yield_curve)
+            if cache is None:
+                cache = {}
+                self._pv_dividends[yield_curve] = cache
+            cache.update(zip(expiries.tolist(), self._calc_pvs_dividends(expiries, yield_curve).tolist()))
+
+    def get_discount_factor(self, time_to_expiry):
+        df = self._discount_factors.get(time_to_expiry)
+        if df is None:
+            df = math.exp(-self.dividend_yield * time_to_expiry)
+        return(df)
+
+    def get_pv_dividends(self, time_to_expiry, yield_curve):
+        '''
+        present value of the discrete dividends paid up to the expiry, discounted on the yield curve
+        '''
+        pv = self._pv_dividends.get(yield_curve, {}).get(time_to_expiry)
+        if pv is None:
+            pv = sum(amount * yield_curve.get_discount_factor(t)
+                     for t, amount in self.dividends if 0 < t <= time_to_expiry)
+        return(pv)
+
+    def get_discount_factors(self, times_to_expiry):
+        times_to_expiry = np.asarray(times_to_expiry, dtype=float)
+        expiries, inverse = np.unique(times_to_expiry, return_inverse=True)
+        dfs = _lookup(self._discount_factors, expiries, lambda t: np.exp(-self.dividend_yield * t))
+        return(dfs[inverse].reshape(times_to_expiry.shape))
+
+    def get_pvs_dividends(self, times_to_expiry, yield_curve):
+        times_to_expiry = np.asarray(times_to_expiry, dtype=float)
+        expiries, inverse = np.unique(times_to_expiry, return_inverse=True)
+        pvs = _lookup(self._pv_dividends.get(yield_curve, {}), expiries,
+                      lambda t: self._calc_pvs_dividends(t, yield_curve))
+        return(pvs[inverse].reshape(times_to_expiry.shape))
+
+    def _calc_pvs_dividends(self, expiries, yield_curve):
+        # (expiries x dividends) table of the discounted amounts paid up to each expiry
+        if not self.dividends:
+            return(np.zeros(len(expiries)))
+        times, amounts = np.array(self.dividends, dtype=float).T
+        paid = (times > 0) & (times[None, :] <= expiries[:, None])
+        return(np.sum(np.where(paid, amounts * yield_curve.get_discount_factors(times), 0), axis=1))
+
+
+def _lookup(cache, expiries, calc):
+    # values of the distinct expiries from the cache, the missing ones are computed by calc in one
+    # vectorized call and not added to the cache
+    values = np.array([cache.get(t, np.nan) for t in expiries.tolist()], dtype=float)
+    missing = np.isnan(values)
+    if np.any(missing):
+        values[missing] = calc(expiries[missing])
+    return(values)
+
+
+def _test():
+    curve = YieldCurve([0.25, 0.5, 1.0, 2.0], [0.04, 0.045, 0.05, 0.052])
+    curve.precompute([0.25, 0.5, 0.75, 1.0])
+    print("Zero rate at 0.75:", curve.get_zero_rate(0.75))
+    print("Discount factor at 0.75:", curve.get_discount_factor(0.75))
+    print("Discount factors:", curve.get_discount_factors([0.5, 0.5, 1.0, 1.5]))
+
+    dividends = DividendCurve('Test', dividend_yield=0.01, dividends=[(0.1, 0.5), (0.6, 0.5)])
+    dividends.precompute([0.5, 1.0], curve)
+    print("PV of dividends to 0.5:", dividends.get_pv_dividends(0.5, curve))
+    print("PV of dividends to 1.0:", dividends.get_pv_dividends(1.0, curve))
+
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,136 @@
+'''
+
+Implied Volatility Surface
+
+'''
+
+import bisect
+import numpy as np
+
+
+class VolatilitySurface(object):
+    '''
+    Implied volatility surface for one underlying on a moneyness (strike / spot) x expiry grid
+    vols[i][j] is the implied vol for expiries[i] and moneyness[j]
+    interpolation is bilinear in moneyness and total variance (sigma^2 * T), flat outside the grid
+    '''
+
+    def __init__(self, ticker, spot_price, moneyness, expiries, vols):
+        self.ticker = ticker
+        self.spot_price = spot_price
+
+        moneyness = np.asarray(moneyness, dtype=float)
+        expiries = np.asarray(expiries, dtype=float)
+        vols = np.asarray(vols, dtype=float).reshape(len(expiries), len(moneyness))
+
+        if np.any(np.diff(moneyness) <= 0) or np.any(np.diff(expiries) <= 0):
+            raise Exception("Moneyness and expiry nodes must be strictly increasing")
+        if expiries[0] <= 0:
+            raise Exception("Expiry nodes must be positive")
+
+        # a single node in either direction is padded so every lookup falls inside a cell
+        if len(moneyness) == 1:
+            moneyness = np.append(moneyness, moneyness[0] + 1.0)
+            vols = np.hstack([vols, vols])
+        if len(expiries) == 1:
+            expiries = np.append(expiries, expiries[0] * 2.0)
+            vols = np.vstack([vols, vols])
+
+        self.moneyness = moneyness
+        self.expiries = expiries
+        self.vols = vols
+
+        self._build_coefficients()
+
+    @classmethod
+    def from_strikes(cls, ticker, spot_price, strikes, expiries, vols):
+        '''
+        build the surface from a strike x expiry grid of implied vols
+        '''
+        moneyness = np.asarray(strikes, dtype=float) / spot_price
+        return(cls(ticker, spot_price, moneyness, expiries, vols))
+
+    def _build_coefficients(self):
+        # total variance w(x, t) = c0 + c1*dx + c2*dt + c3*dx*dt inside each cell,
+        # with dx, dt measured from the lower-left node of the cell
+        w = self.vols ** 2 * self.expiries[:, None]
+        hx = np.diff(self.moneyness)[None, :]
+        ht = np.diff(self.expiries)[:, None]
+
+        w00 = w[:-1, :-1]
+        w01 = w[:-1, 1:]
+        w10 = w[1:, :-1]
+        w11 = w[1:, 1:]
+
+        self._c0 = w00
+        self._c1 = (w01 - w00) / hx
+        self._c2 = (w10 - w00) / ht
+        self._c3 = (w11 - w10 - w01 + w00) / (hx * ht)
+
+        # plain lists for the scalar lookup path, which avoids numpy overhead per option
+        self._moneyness_list = self.moneyness.tolist()
+        self._expiries_list = self.expiries.tolist()
+        self._coefficients_list = np.stack([self._c0, self._c1, self._c2, self._c3], axis=-1).tolist()
+
+    def get_vols(self, strikes, times_to_expiry, spot_price=None):
+        '''
+        vectorized lookup of implied vols for arrays of strikes and times to expiry
+        '''
+        if spot_price is None:
+            spot_price = self.spot_price
+
+        x = np.asarray(strikes, dtype=float) / spot_price
+        t = np.asarray(times_to_expiry, dtype=float)
+        x, t = np.broadcast_arrays(x, t)
+
+        x = np.clip(x, self.moneyness[0], self.moneyness[-1])
+        t = np.clip(t, self.expiries[0], self.expiries[-1])
+
+        ix = np.clip(np.searchsorted(self.moneyness, x, side='right') - 1, 0, len(self.moneyness) - 2)
+        it = np.clip(np.searchsorted(self.expiries, t, side='right') - 1, 0, len(self.expiries) - 2)
+
+        dx = x - self.moneyness[ix]
+        dt = t - self.expiries[it]
+        w = self._c0[it, ix] + self._c1[it, ix] * dx + self._c2[it, ix] * dt + self._c3[it, ix] * dx * dt
+
+        return(np.sqrt(w / t))
+
+    def get_vol(self, strike, time_to_expiry, spot_price=None):
+        '''
+        scalar lookup of the implied vol for a single strike and time to expiry
+        '''
+        if spot_price is None:
+            spot_price = self.spot_price
+
+        mx = self._moneyness_list
+        ex = self._expiries_list
+        x = min(max(strike / spot_price, mx[0]), mx[-1])
+        t = min(max(time_to_expiry, ex[0]), ex[-1])
+
+        ix = min(max(bisect.bisect_right(mx, x) - 1, 0), len(mx) - 2)
+        it = min(max(bisect.bisect_right(ex, t) - 1, 0), len(ex) - 2)
+
+        dx = x - mx[ix]
+        dt = t - ex[it]
+        c0, c1, c2, c3 = self._coefficients_list[it][ix]
+        w = c0 + c1 * dx + c2 * dt + c3 * dx * dt
+
+        return((w / t) ** 0.5)
+
+
+def _test():
+    spot_price = 42
+    strikes = [30, 35, 40, 45, 50]
+    expiries = [0.25, 0.5, 1.0]
+    vols = [[0.30, 0.25, 0.21, 0.20, 0.22],
+            [0.28, 0.24, 0.21, 0.20, 0.21],
+            [0.26, 0.23, 0.21, 0.20, 0.20]]
+
+    surface = VolatilitySurface.from_strikes('Test', spot_price, strikes, expiries, vols)
+    print("Vol at K=40, T=0.5:", surface.get_vol(40, 0.5))
+    print("Vol at K=42, T=0.75:", surface.get_vol(42, 0.75))
+    print("Chain vols for T=0.5:", surface.get_vols(np.arange(30, 51, 5), 0.5))
+
+
+if __name__ == "__main__":
+    _test()